@@ -1,45 +1,84 @@
 #!/usr/bin/env python3
+import hashlib
+import json
+import os
+import shutil
 from pathlib import Path
 import re
 import subprocess
 import sys
+from typing import Final
 
 
-COMMON_BRANCHES = [
+COMMON_BRANCHES: Final = [
     "develop",
     "main",
     "master",
 ]
-DEFAULT_CONTEXT_LINES = 5
+DEFAULT_CONTEXT_LINES: Final = 5
+DEFAULTS: Final[dict[str, str]] = {}
+DIFF_READ_SIZE: Final = 64 * 1024
+# Environment variables that redirect git to other repos/config, making the memo file unreliable
+MEMO_BYPASS_ENV: Final = [
+    "GIT_DIR",
+    "GIT_COMMON_DIR",
+    "GIT_CONFIG",
+    "GIT_CONFIG_COUNT",
+    "GIT_CONFIG_GLOBAL",
+    "GIT_CONFIG_NOSYSTEM",
+    "GIT_CONFIG_PARAMETERS",
+    "GIT_CONFIG_SYSTEM",
+]
+
+# Config files with these sections pull in other files, which the memo can't keep track of
+INCLUDE_SECTION: Final = re.compile(rb"^[ \t]*\[[ \t]*include", re.MULTILINE | re.IGNORECASE)
+
+# Patterns for parsing the lines of each file in `git diff` output, compiled once at import.
+# The diff is scanned and printed as raw bytes, without ever being decoded.
+# Text groups are lazy and never end in CR, so that CRLF (or CR CR LF) line endings are left out of the printed text.
+HUNK_HEADER_PATTERN: Final = rb"(?P<hunk>@@ -[0-9]+(?:,[0-9]+)? \+(?P<new_start>[0-9]+)(?:,[0-9]+)? @@[^\n]*)"
+# Only one quantifier is free to move at a time in TODO_PATTERN, and the `\r*$` after it accepts any line ending,
+# so the first comment marker followed by TODO always matches. That keeps long lines from backtracking heavily.
+TODO_PATTERN: Final = rb"(?P<todo>\+[^\n]*?(?P<todo_text>(?:#|//|/\*)[ \t]*TODO[: \t][^\n]*?[^\r\n]))"  # TODO: Find TODO anywhere in comment, not just at the beginning. We may want to trim text that appears before the TODO though... How to display that cleanly? Maybe use comment char and ellipsis:   # ... TODO: figure this out
+# Jumps straight to the next line that starts a hunk or holds a TODO, skipping everything in between
+TODO_OR_HUNK: Final = re.compile(
+    rb"^(?:" + HUNK_HEADER_PATTERN + rb"|" + TODO_PATTERN + rb")\r*$",
+    re.MULTILINE | re.IGNORECASE,
+)
+# Classifies each line of a file's diff; the matched alternative is reported by `lastgroup`.
+# Removed lines don't match at all, so `finditer` skips over them without returning to Python
+# (they don't interrupt a TODO, and don't exist in new version of file).
+DIFF_LINE: Final = re.compile(
+    rb"^(?:"
+    + HUNK_HEADER_PATTERN
+    + rb"|"
+    + TODO_PATTERN
+    + rb"|(?P<comment>[ \+][ \t]*(?P<comment_text>(?:#|//|/\*)[^\n]*?[^\r\n]))"
+    rb"|(?P<new>[ \+][^\n]*)"
+    rb"|(?P<other>[^\n\-][^\n]*)"
+    rb")\r*$",
+    re.MULTILINE | re.IGNORECASE,
+)
 
 
 def install_alias():
     # Install a `git todo` alias that runs this script
     if len(sys.argv) > 1:
         if sys.argv[1] == "--install":
-            import shutil
-            from pathlib import Path
-
             interpreter = Path(sys.executable).as_posix()
             try:
+                # Look interpreters up on the PATH, rather than starting them to see if they exist
                 if sys.platform == "win32":
                     # Prefer `py` launcher, if available
                     py = shutil.which("py")
                     if py:
-                        subprocess.check_call(
-                            [py, "--version"],
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL,
-                        )
                         interpreter = Path(py).as_posix()
                 else:
-                    subprocess.check_call(
-                        ["python3", "--version"],
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                    )
-                    interpreter = "python3"
-            except:
+                    # Prefer `python3`, as long as it's the same interpreter we're running under
+                    python3 = shutil.which("python3")
+                    if python3 and os.path.samefile(python3, sys.executable):
+                        interpreter = "python3"
+            except OSError:
                 # Fallback to specifying current interpreter, even though this may break if Python is upgraded
                 pass
             subprocess.check_call(
@@ -61,55 +100,78 @@ def install_alias():
             return True
 
 
-def guess_main_branch():
-    # Try to detect common branch names
-    branches = subprocess.check_output(
-        [
-            "git",
-            "branch",
-            "--list",
-            "--format=%(refname:lstrip=2)",
-            "--",
-            *COMMON_BRANCHES,
-        ],
-        encoding="utf-8",
-    ).splitlines()
+def start_git(*args, encoding="utf-8", stderr=None):
+    # Start a git command without waiting for it, so that independent commands can run concurrently
+    return subprocess.Popen(
+        ["git", *args], stdout=subprocess.PIPE, stderr=stderr, encoding=encoding
+    )
+
+
+def read_git(proc, *allowed_returncodes):
+    output, _ = proc.communicate()
+    if proc.returncode and proc.returncode not in allowed_returncodes:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args, output)
+    return output
+
+
+def list_branches():
+    # List all local branches
+    return start_git("branch", "--list", "--format=%(refname:lstrip=2)")
+
+
+def find_git_dir_proc():
+    # Ask git where the git directory is, to confirm the one found without starting git
+    return start_git("rev-parse", "--absolute-git-dir", stderr=subprocess.DEVNULL)
+
+
+def find_remote_head():
+    # Ask for the default branch of the `origin` remote, as recorded by `git clone` or `git remote set-head`
+    return start_git(
+        "symbolic-ref",
+        "--quiet",
+        "--short",
+        "refs/remotes/origin/HEAD",
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def get_remote_head(proc):
+    # Not every repo has a remote (or knows its default branch), so failure just means there's nothing to go on
+    output, _ = proc.communicate()
+    if proc.returncode == 0:
+        return output.removesuffix("\n") or None
+
+
+def guess_main_branch(branches, remote_head):
+    # Now that all local branches are listed, there may be many of them
+    branches = frozenset(branches)
+    # Try to detect common branch names.
     # Prefer branches according to order defined above, not the (sorted) order git returns them in
     for b in COMMON_BRANCHES:
         if b and b in branches:
             print(f"Guessed main branch: {b}", file=sys.stderr)
             return b
+    # Otherwise use the remote's default branch, preferring a local branch of the same name
+    if remote_head:
+        b = remote_head.removeprefix("origin/")
+        if b not in branches:
+            b = remote_head
+        print(f"Guessed main branch: {b}", file=sys.stderr)
+        return b
     raise ValueError(
         "Unable to guess main branch! Specify as command line argument, or create config file .git-todo"
     )
 
 
-def find_repo_root():
-    # Find root of git repo
-    return Path(
-        subprocess.check_output(
-            [
-                "git",
-                "rev-parse",
-                "--show-toplevel",
-            ],
-            encoding="utf-8",
-        ).removesuffix("\n")
-    )
+def list_config():
+    # Ask git for all config entries in the [todo] section
+    return start_git("config", "--null", "--get-regexp", r"^todo\.")
 
 
-def get_config():
+def get_config(proc):
     config = DEFAULTS.copy()
-    for entry in subprocess.check_output(
-        [
-            "git",
-            "config",
-            "--null",
-            "--get-regexp",
-            r"^todo\.",
-        ],
-        encoding="utf-8",
-    ).split("\0"):
+    # `git config --get-regexp` exits with status 1 when there are no matching entries
+    for entry in read_git(proc, 1).split("\0"):
         if entry:
             key, _sep, value = entry.partition("\n")
             key = key.removeprefix("todo.")
@@ -117,25 +179,273 @@ def get_config():
     return config
 
 
-def main():
-    try:
-        git_repo_root = find_repo_root()
-    except subprocess.CalledProcessError as e:
-        # `git rev-parse` fails with a short error message to stderr if not inside a repo.
-        # Much better than `git diff`, which spams it's full help text.
-        exit(e.returncode)
+def find_git_dir():
+    # Find the git directory (and the common directory shared by worktrees) without starting git
+    cwd = Path.cwd()
+    for directory in [cwd, *cwd.parents]:
+        git_dir = directory / ".git"
+        if git_dir.is_file():
+            # Worktrees and submodules have a `.git` file that points to the real directory
+            content = git_dir.read_text(encoding="utf-8")
+            if not content.startswith("gitdir: "):
+                return None
+            git_dir = directory / content.removeprefix("gitdir: ").strip()
+        elif not git_dir.is_dir():
+            if (
+                (directory / "HEAD").is_file()
+                and (directory / "objects").is_dir()
+                and (directory / "refs").is_dir()
+            ):
+                # Inside a bare repo (or a git dir itself), which has no `.git` entry of its own
+                return None
+            continue
+        common_dir = git_dir
+        if (git_dir / "commondir").is_file():
+            common_dir = git_dir / (git_dir / "commondir").read_text(encoding="utf-8").strip()
+        return git_dir.resolve(), common_dir.resolve()
+    return None
 
-    # Ask git for all config entries in the [todo] section
+
+def find_memo():
+    # Locate the memo file for this repo, along with a stamp of everything the memoized results depend on
+    if any(v in os.environ for v in MEMO_BYPASS_ENV):
+        return None
     try:
-        config = get_config()
-    except subprocess.CalledProcessError as e:
-        exit(e.returncode)
+        if not (dirs := find_git_dir()):
+            return None
+    except OSError:
+        return None
+    git_dir, common_dir = dirs
+    config_home = Path(os.environ.get("XDG_CONFIG_HOME") or Path.home() / ".config")
+    cache_home = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    config_paths = [
+        common_dir / "config",
+        git_dir / "config.worktree",
+        Path.home() / ".gitconfig",
+        config_home / "git" / "config",
+        Path("/etc/gitconfig"),
+    ]
+    if git := shutil.which("git"):
+        # System config lives under git's install prefix, which isn't always /usr
+        config_paths.append(Path(git).resolve().parent.parent / "etc" / "gitconfig")
+    stamp = [str(git_dir)]
+    for path in config_paths:
+        try:
+            stamp.append(path.stat().st_mtime_ns)
+            # Included files could be anywhere, so there's no telling when they change
+            if INCLUDE_SECTION.search(path.read_bytes()):
+                return None
+        except OSError:
+            stamp.append(None)
+    for path in [
+        git_dir / "HEAD",
+        common_dir / "packed-refs",
+        common_dir / "refs" / "heads",
+        common_dir / "refs" / "remotes" / "origin" / "HEAD",
+        # Repos using the reftable backend rewrite this list on every ref update
+        common_dir / "reftable" / "tables.list",
+    ]:
+        try:
+            stamp.append(path.stat().st_mtime_ns)
+        except OSError:
+            stamp.append(None)
+    name = hashlib.sha1(str(git_dir).encode("utf-8", "surrogateescape")).hexdigest()
+    return cache_home / "git-todo" / f"{name}.json", stamp
+
+
+def read_memo(memo):
+    if memo:
+        memo_path, stamp = memo
+        try:
+            with open(memo_path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if isinstance(data, dict) and data.get("stamp") == stamp:
+            return data
+
+
+def memo_matches(memo, proc):
+    # Check that the memo belongs to the git directory that git actually used
+    output, _ = proc.communicate()
+    _memo_path, stamp = memo
+    if proc.returncode:
+        return False
+    return str(Path(output.removesuffix("\n")).resolve()) == stamp[0]
+
+
+def write_memo(memo, data):
+    if memo:
+        memo_path, stamp = memo
+        try:
+            memo_path.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file and rename it into place, so concurrent runs never see a partial memo
+            temp_path = memo_path.with_name(f"{memo_path.name}.{os.getpid()}.tmp")
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"stamp": stamp, **data}, f)
+            os.replace(temp_path, memo_path)
+        except OSError:
+            # The memo is only an optimization
+            pass
+
+
+def find_line(data, prefix, start):
+    # Find the next line that begins with `prefix`, whose preceding newline is at or after `start`
+    i = data.find(b"\n" + prefix, start)
+    return i + 1 if i >= 0 else -1
+
+
+def find_file_name(diff, start):
+    # Find the `--- old` / `+++ new` lines after `start`, returning the new file name and the end of its line
+    plus = start
+    while (plus := find_line(diff, b"+++ ", plus)) >= 0:
+        minus = diff.rfind(b"\n", start, plus - 1) + 1
+        plus_end = diff.find(b"\n", plus)
+        if plus_end < 0:
+            plus_end = len(diff)
+        # Both lines need a (non-empty) file name
+        if (
+            minus > start
+            and diff.startswith(b"--- ", minus)
+            and plus - 1 > minus + 4
+            and plus_end > plus + 4
+        ):
+            return diff[plus + 4 : plus_end], plus_end
+    return None, -1
+
+
+def split_files(diff):
+    # Slice diff into files, finding headers with plain substring searches
+    files: list[list[bytes]] = []
+    pos = 0
+    end = len(diff)
+    start = 0 if diff.startswith(b"diff --git ") else find_line(diff, b"diff --git ", 0)
+    while start >= 0:
+        # Headers without their own ---/+++ lines (e.g. binary files) are merged into the next file
+        start_end = diff.find(b"\n", start)
+        if start_end < 0:
+            end = start
+            break
+        file_name, header_end = find_file_name(diff, start_end)
+        if header_end < 0:
+            end = start
+            break
+        if len(files) > 0:
+            files[-1][1] = diff[pos:start]
+        files.append([file_name, None])
+        pos = header_end
+        start = find_line(diff, b"diff --git ", pos)
+    if len(files) > 0:
+        files[-1][1] = diff[pos:end]
+    return files
+
+
+def read_files(stream):
+    # Slice a diff into files as it is read, so only the file currently being parsed is held in memory
+    boundary = b"\ndiff --git "
+    buffer = bytearray()
+    while chunk := stream.read(DIFF_READ_SIZE):
+        # Only the new data (and a partial boundary at the end of the old data) needs to be searched
+        search_start = max(len(buffer) - len(boundary) + 1, 0)
+        buffer += chunk
+        # Everything before the last file header is complete
+        split = buffer.rfind(boundary, search_start)
+        if split >= 0:
+            yield from split_files(buffer[: split + 1])
+            del buffer[: split + 1]
+    yield from split_files(buffer)
+
+
+def find_todos(file_diff):
+    # Yield the line number of each TODO, along with its text and any aligned comments that directly follow it.
+    # Runs of uninteresting lines are skipped by a single regex search, and new lines in them are counted rather
+    # than visited; lines are only stepped through one by one while following a TODO (until end of context lines).
+    pos = 0
+    # Line number in new version of file, for the first line after `line_pos`
+    line = 0
+    line_pos = 0
+    while m := TODO_OR_HUNK.search(file_diff, pos):
+        pos = m.end()
+        if m.lastgroup == "hunk":
+            line = int(m["new_start"])
+            line_pos = pos
+            continue
+        # Only context and added lines exist in new version of file
+        line += file_diff.count(b"\n ", line_pos, m.start())
+        line += file_diff.count(b"\n+", line_pos, m.start())
+        todo_line = line
+        texts = [m["todo_text"]]
+        indent = m.start("todo_text") - m.start()
+        line += 1
+        line_pos = pos
+        for m in DIFF_LINE.finditer(file_diff, pos):
+            kind = m.lastgroup
+            if kind == "todo":
+                texts.append(m["todo_text"])
+                indent = m.start("todo_text") - m.start()
+            elif (
+                kind == "comment"
+                and m.start("comment_text") - m.start() == indent
+                and m["comment_text"].lstrip(b"#/ \t")
+            ):
+                texts.append(m["comment_text"])
+            else:
+                # Resume searching from this line, which hasn't been counted yet
+                pos = m.start()
+                line_pos = pos - 1
+                break
+            line += 1
+            line_pos = m.end()
+        else:
+            pos = len(file_diff)
+        yield todo_line, texts
+
+
+def scan_file(file_name, file_diff):
+    # Format the output for one file as a single block, so it can be written out in one go.
+    # Bytes are used so that source text is passed through exactly as git gave it to us.
+    lines: list[bytes] = []
+    # Skip files without any TODOs (a plain substring scan is much cheaper than the regex)
+    if b"todo" in file_diff.lower():
+        for line, texts in find_todos(file_diff):
+            lines.append(b"%s:%d\n" % (file_name, line))
+            for text in texts:
+                lines.append(b"    %s\n" % text)
+    return b"".join(lines)
+
+
+def main():
+    # Reuse config and branches from a previous run, if nothing they depend on has changed since
+    memo = find_memo()
+    if data := read_memo(memo):
+        config = data["config"]
+        branches = data["branches"]
+        remote_head = data["remote_head"]
+    else:
+        # Query config and branches concurrently, rather than paying for each git startup in turn
+        config_proc = list_config()
+        branches_proc = list_branches()
+        remote_head_proc = find_remote_head()
+        git_dir_proc = find_git_dir_proc() if memo else None
+        remote_head = get_remote_head(remote_head_proc)
+        try:
+            config = get_config(config_proc)
+            # `git branch` fails with a short error message to stderr if not inside a repo.
+            # Much better than `git diff`, which spams it's full help text.
+            branches = read_git(branches_proc).splitlines()
+        except subprocess.CalledProcessError as e:
+            exit(e.returncode)
+        if git_dir_proc and memo_matches(memo, git_dir_proc):
+            write_memo(
+                memo,
+                {"config": config, "branches": branches, "remote_head": remote_head},
+            )
 
     # Process arguments
     branch_args = [a for a in sys.argv[1:] if not a.startswith("-")]
     diff_args = [a for a in sys.argv[1:] if a.startswith("-")]
     if len(branch_args) == 0:
-        branch = config.get("default-branch") or guess_main_branch()
+        branch = config.get("default-branch") or guess_main_branch(branches, remote_head)
         branch_args.append(branch)
     if len(branch_args) == 1:
         diff_args.insert(0, "--merge-base")
@@ -145,83 +455,24 @@ def main():
         context_lines = int(config.get("context-lines") or "")
     except ValueError:
         context_lines = DEFAULT_CONTEXT_LINES
-    diff = subprocess.check_output(
-        [
-            "git",
-            "diff",
-            f"--unified={context_lines}",
-            "--diff-algorithm=histogram",
-            "--no-color",
-            "--no-prefix",
-            "--no-relative",
-            *diff_args,
-            *branch_args,
-        ],
-        encoding="utf-8",
-    )
+    with start_git(
+        "diff",
+        f"--unified={context_lines}",
+        "--diff-algorithm=histogram",
+        "--no-color",
+        "--no-prefix",
+        "--no-relative",
+        *diff_args,
+        *branch_args,
+        encoding=None,
+    ) as diff_proc:
+        # Search for TODOs in files, writing each file's output as soon as it's scanned
+        out = sys.stdout.buffer
+        for [file_name, file_diff] in read_files(diff_proc.stdout):  # TODO: Use comment syntax based on file type
+            out.write(scan_file(file_name, file_diff))
 
-    # Slice diff into files
-    FILE_HEADER_START = re.compile(r"^diff --git [^\n]+$", re.MULTILINE)
-    FILE_HEADER_END = re.compile(r"^--- ([^\n]+)\n\+\+\+ ([^\n]+)$", re.MULTILINE)
-    files: list[list[str]] = []
-    pos = 0
-    while (m_start := FILE_HEADER_START.search(diff, pos)) and (
-        m_end := FILE_HEADER_END.search(diff, m_start.end())
-    ):
-        if len(files) > 0:
-            files[-1][2] = diff[pos : m_start.start()]
-        files.append([m_end.group(2), diff[m_start.start() : m_end.end()], None])
-        pos = m_end.end()
-    if len(files) > 0:
-        if m_start:
-            files[-1][2] = diff[pos : m_start.start()]
-        else:
-            files[-1][2] = diff[pos:]
-
-    # Search for TODOs in files
-    TODO = re.compile(
-        r"^\+[^\n]*((?:#|//|/\*)[ \t]*TODO[: \t][ \t]*[^\n]+)$",  # TODO: Find TODO anywhere in comment, not just at the beginning. We may want to trim text that appears before the TODO though... How to display that cleanly? Maybe use comment char and ellipsis:   # ... TODO: figure this out
-        re.MULTILINE | re.IGNORECASE,
-    )
-    COMMENT = re.compile(
-        r"^[ \+][ \t]*((?:#|//|/\*)[^\n]+)$",
-        re.MULTILINE | re.IGNORECASE,
-    )
-    HUNK_HEADER = re.compile(
-        r"^@@ -([0-9]+)(?:,([0-9]+))? \+([0-9]+)(?:,([0-9]+))? @@[^\n]*$", re.MULTILINE
-    )
-    for [file_name, file_header, file_diff] in files:  # TODO: Use comment syntax based on file type
-        # Skip files without any TODOs
-        if TODO.search(file_diff):
-            # Parse the diff to know where the TODOs are
-            new_line = 0
-            count = 0
-            indent = 0
-            for line in file_diff.splitlines():
-                if m := HUNK_HEADER.match(line):
-                    new_line = int(m.group(3))
-                    count = 0
-                elif line:
-                    # Print TODOs and aligned comments that directly follow them (until end of context lines)
-                    if m := TODO.search(line):
-                        if count == 0:
-                            print(f"{file_name}:{new_line}")
-                        print(f"    {m[1]}")
-                        count = 1
-                        indent = m.start(1)
-                    elif count > 0 and line[0] != "-":
-                        if (
-                            (m := COMMENT.search(line))
-                            and m.start(1) == indent
-                            and m.group(1).lstrip("#/ \t")
-                        ):
-                            print(f"    {m[1]}")
-                            count += 1
-                        else:
-                            count = 0
-                    # Track line numbers in new version of file
-                    if line[0] in " +":
-                        new_line += 1
+    if diff_proc.returncode:
+        raise subprocess.CalledProcessError(diff_proc.returncode, diff_proc.args)
 
 
 if __name__ == "__main__":